@@ -21,7 +21,7 @@
 
 from collections.abc import Callable, Sequence
 import functools
-from typing import Any, TypeVar
+from typing import Any, Literal, TypeVar
 
 import haiku as hk
 import jax
@@ -32,33 +32,68 @@ Pytree = Any
 PytreeJaxArray = Any
 
 partial = functools.partial
-PROXY = object()
 
 T = TypeVar("T")
 
 
-def _maybe_slice(array, i, slice_size, axis):
-  if axis is PROXY:
-    return array
-  else:
-    return jax.lax.dynamic_slice_in_dim(
-        array, i, slice_size=slice_size, axis=axis
+def _identity_slice(array, slice_start, slice_size):
+  del slice_start, slice_size  # Unused, the array is broadcast.
+  return array
+
+
+@functools.lru_cache(maxsize=128)
+def _leaf_slicers(flat_axes):
+  """Per-leaf functions `(array, slice_start, slice_size) -> slice`."""
+
+  def make_slicer(axis):
+    if axis is None:
+      return _identity_slice
+    # Slice starts are never negative, which spares the index wrapping ops.
+    return lambda array, slice_start, slice_size: jax.lax.dynamic_slice_in_dim(
+        array,
+        slice_start,
+        slice_size=slice_size,
+        axis=axis,
+        allow_negative_indices=False,
     )
 
+  return tuple(make_slicer(axis) for axis in flat_axes)
+
+
+def _pad_axis(array, axis, pad_size):
+  padding = [(0, 0)] * array.ndim
+  padding[axis] = (0, pad_size)
+  return jnp.pad(array, padding)
 
-def _maybe_get_size(array, axis):
-  if axis == PROXY:
-    return -1
+
+def _maybe_cast(array, dtype):
+  if jnp.issubdtype(array.dtype, jnp.floating):
+    return array.astype(dtype)
   else:
-    return array.shape[axis]
+    return array
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_flatten_axes(values_tree_def, axes, name):
+  return tuple(jax.api_util.flatten_axes(name, values_tree_def, axes))
 
 
-def _expand_axes(axes, values, name="sharded_apply"):
-  values_tree_def = jax.tree_util.tree_structure(values)
-  flat_axes = jax.api_util.flatten_axes(name, values_tree_def, axes)
-  # Replace None's with PROXY.
-  flat_axes = [PROXY if x is None else x for x in flat_axes]
-  return jax.tree_util.tree_unflatten(values_tree_def, flat_axes)
+def _flatten_axes(values_tree_def, axes, name="sharded_apply"):
+  """Flattens `axes` to one axis (or None) per leaf, cached if hashable."""
+  try:
+    hash(axes)
+  except TypeError:
+    # Unhashable axes (e.g. containing lists) can't be cached.
+    return _cached_flatten_axes.__wrapped__(values_tree_def, axes, name)
+  return _cached_flatten_axes(values_tree_def, axes, name)
+
+
+def _expand_out_axes(out_axes, outputs, name="sharded_apply"):
+  outputs_tree_def = jax.tree_util.tree_structure(outputs)
+  flat_axes = _flatten_axes(outputs_tree_def, out_axes, name)
+  if None in flat_axes:
+    raise ValueError(f"{name} out_axes can't be None, got {out_axes}.")
+  return jax.tree_util.tree_unflatten(outputs_tree_def, flat_axes)
 
 
 def sharded_map(
@@ -88,6 +123,21 @@ def sharded_map(
     # Guarantees initialisation independent of shard_size. Doesn't incur a high
     # memory cost, as long as large concrete tensors are not encountered.
     return hk.vmap(fun, in_axes=in_axes, out_axes=out_axes, split_rng=False)
+  elif shard_size == 1:
+    # Each shard holds a single element, so instead of vmapping over a
+    # singleton axis just drop it on the way in and restore it on the way out.
+    def squeezed_fun(*args):
+      args_flat, args_tree_def = jax.tree_util.tree_flatten(args)
+      flat_in_axes = _flatten_axes(args_tree_def, in_axes, name="sharded_map")
+      args_flat = [
+          array if axis is None else jnp.squeeze(array, axis)
+          for array, axis in zip(args_flat, flat_in_axes)
+      ]
+      out = fun(*jax.tree_util.tree_unflatten(args_tree_def, args_flat))
+      out_axes_ = _expand_out_axes(out_axes, out, name="sharded_map")
+      return jax.tree.map(jnp.expand_dims, out, out_axes_)
+
+    return sharded_apply(squeezed_fun, shard_size, in_axes, out_axes)
   else:
     vmapped_fun = hk.vmap(fun, in_axes, out_axes, split_rng=True)
     return sharded_apply(vmapped_fun, shard_size, in_axes, out_axes)
@@ -109,6 +159,11 @@ def sharded_apply(
     in_axes: int | Pytree = 0,
     out_axes: int | Pytree = 0,
     new_out_axes: bool = False,
+    unroll: int | bool = 1,
+    pad_to_multiple: bool = False,
+    remat: bool = False,
+    in_place_outputs: bool = False,
+    accum_dtype: jnp.dtype | None = None,
 ) -> Callable[..., PytreeJaxArray]:
   """Sharded apply.
 
@@ -127,6 +182,26 @@ def sharded_apply(
     new_out_axes: Whether to stack outputs on new axes. This assumes that the
       output sizes for each shard (including the possible remainder shard) are
       the same.
+    unroll: Number of shards to unroll per iteration of the underlying scan.
+      Larger values reduce loop overhead and let XLA fuse across adjacent
+      shards, at the cost of compile time and peak memory. If True, or if there
+      are no more than `unroll` (> 1) shards, the scan is unrolled fully, which
+      grows compile time linearly with the number of shards.
+    pad_to_multiple: Whether to zero-pad the mapped input axes up to a multiple
+      of `shard_size` and slice the outputs back afterwards. This avoids
+      compiling `fun` a second time for the remainder shard, at the cost of
+      computing on padding. `fun` must tolerate zero inputs in the padding.
+    remat: Whether to rematerialise the activations of each shard in the
+      backward pass instead of saving them, so only one shard's activations
+      are live at a time.
+    in_place_outputs: Whether to write the shard outputs into a preallocated
+      output buffer carried through the scan, rather than stacking them and
+      merging them afterwards. This avoids the extra output-sized copy made
+      when merging the remainder shard or moving the mapped axis, which
+      matters for large outputs split into many shards.
+    accum_dtype: If set, floating point outputs of each shard are cast to this
+      dtype before being collected, e.g. bfloat16 to halve the memory traffic
+      of accumulating large outputs. None keeps the output dtypes of `fun`.
 
   Returns:
     Function with smap applied.
@@ -144,114 +219,317 @@ def sharded_apply(
   @_set_docstring(docstr)
   @functools.wraps(fun)
   def mapped_fn(*args, **kwargs):
-    # Expand in axes and determine loop range.
-    in_axes_ = _expand_axes(in_axes, args)
-
-    in_sizes = jax.tree.map(_maybe_get_size, args, in_axes_)
-    in_size = max(jax.tree_util.tree_leaves(in_sizes))
+    # Flatten in axes and determine loop range.
+    args_flat, args_tree_def = jax.tree_util.tree_flatten(args)
+    flat_in_axes = _flatten_axes(args_tree_def, in_axes)
+    slicers = _leaf_slicers(flat_in_axes)
+
+    in_size = max(
+        array.shape[axis]
+        for array, axis in zip(args_flat, flat_in_axes)
+        if axis is not None
+    )
 
-    num_extra_shards = (in_size - 1) // shard_size
+    padded_size = in_size
+    if pad_to_multiple:
+      padded_size = -(-in_size // shard_size) * shard_size
+      pad_size = padded_size - in_size
+      args_flat = [
+          array if axis is None else _pad_axis(array, axis, pad_size)
+          for array, axis in zip(args_flat, flat_in_axes)
+      ]
 
     # Fix if necessary.
-    last_shard_size = in_size % shard_size
+    last_shard_size = padded_size % shard_size
     last_shard_size = shard_size if last_shard_size == 0 else last_shard_size
 
     def apply_fun_to_slice(slice_start, slice_size):
-      input_slice = jax.tree.map(
-          lambda array, axis: _maybe_slice(
-              array, slice_start, slice_size, axis
-          ),
-          args,
-          in_axes_,
+      input_slice = [
+          slicer(array, slice_start, slice_size)
+          for slicer, array in zip(slicers, args_flat)
+      ]
+      input_slice = jax.tree_util.tree_unflatten(args_tree_def, input_slice)
+      outputs = fun(*input_slice, **kwargs)
+      if accum_dtype is not None:
+        outputs = jax.tree.map(partial(_maybe_cast, dtype=accum_dtype), outputs)
+      return outputs
+
+    if remat:
+      apply_fun_to_slice = hk.remat(
+          apply_fun_to_slice,
+          policy=jax.checkpoint_policies.nothing_saveable,
+          static_argnums=(1,),
       )
-      return fun(*input_slice, **kwargs)
 
-    remainder_shape_dtype = hk.eval_shape(
-        partial(apply_fun_to_slice, 0, last_shard_size)
-    )
-    out_dtypes = jax.tree.map(lambda x: x.dtype, remainder_shape_dtype)
-    out_shapes = jax.tree.map(lambda x: x.shape, remainder_shape_dtype)
-    out_axes_ = _expand_axes(out_axes, remainder_shape_dtype)
+    def scan_iteration(carry, shard_index):
+      # Per-shard outputs are stacked by the scan rather than written into a
+      # carried buffer, which XLA would otherwise have to copy every iteration.
+      return carry, apply_fun_to_slice(shard_index * shard_size, shard_size)
+
+    def merge_shards(stacked, axis):
+      # Merges the leading shard axis into the mapped output axis.
+      axis = axis % (stacked.ndim - 1)
+      merged = jnp.moveaxis(stacked, 0, axis)
+      return merged.reshape(
+          merged.shape[:axis] + (-1,) + merged.shape[axis + 2 :]
+      )
+
+    num_shards = padded_size // shard_size
+
+    if num_shards == 0:
+      # A single shard smaller than shard_size, no scan needed.
+      return apply_fun_to_slice(0, in_size)
+
+    fully_unroll = unroll is True or 1 < num_shards <= unroll
 
-    if num_extra_shards > 0:
-      regular_shard_shape_dtype = hk.eval_shape(
+    if in_place_outputs:
+      shard_shape_dtype = hk.eval_shape(
           partial(apply_fun_to_slice, 0, shard_size)
       )
-      shard_shapes = jax.tree.map(lambda x: x.shape, regular_shard_shape_dtype)
-
-      def make_output_shape(axis, shard_shape, remainder_shape):
-        return (
-            shard_shape[:axis]
-            + (shard_shape[axis] * num_extra_shards + remainder_shape[axis],)
-            + shard_shape[axis + 1 :]
+      out_axes_ = _expand_out_axes(out_axes, shard_shape_dtype)
+
+      def allocate_buffer(shape_dtype, axis):
+        shape = list(shape_dtype.shape)
+        shape[axis] = padded_size
+        return jnp.zeros(shape, dtype=shape_dtype.dtype)
+
+      def compute_shard(outputs, slice_start, slice_size):
+        slice_out = apply_fun_to_slice(slice_start, slice_size)
+        return jax.tree.map(
+            lambda output, update, axis: jax.lax.dynamic_update_slice_in_dim(
+                output, update, slice_start, axis
+            ),
+            outputs,
+            slice_out,
+            out_axes_,
         )
 
-      out_shapes = jax.tree.map(
-          make_output_shape, out_axes_, shard_shapes, out_shapes
+      outputs = jax.tree.map(allocate_buffer, shard_shape_dtype, out_axes_)
+      # The buffer is the scan carry, so each shard's output is written into it
+      # in place.
+      outputs, _ = hk.scan(
+          lambda outputs, shard_index: (
+              compute_shard(outputs, shard_index * shard_size, shard_size),
+              None,
+          ),
+          outputs,
+          jax.lax.iota(jnp.int32, num_shards),
+          unroll=True if fully_unroll else max(1, unroll),
       )
 
-    # Calls dynamic Update slice with different argument order.
-    # This is here since tree_map only works with positional arguments.
-    def dynamic_update_slice_in_dim(full_array, update, axis, i):
-      return jax.lax.dynamic_update_slice_in_dim(full_array, update, i, axis)
+      if last_shard_size != shard_size:
+        remainder_start = in_size - last_shard_size
+        outputs = compute_shard(outputs, remainder_start, last_shard_size)
+    else:
+      _, stacked_outputs = hk.scan(
+          scan_iteration,
+          (),
+          jax.lax.iota(jnp.int32, num_shards),
+          unroll=True if fully_unroll else max(1, unroll),
+      )
+      out_axes_ = _expand_out_axes(out_axes, stacked_outputs)
+      outputs = jax.tree.map(merge_shards, stacked_outputs, out_axes_)
+
+      if last_shard_size != shard_size:
+        remainder_start = in_size - last_shard_size
+        remainder = apply_fun_to_slice(remainder_start, last_shard_size)
+        outputs = jax.tree.map(
+            lambda output, update, axis: jnp.concatenate(
+                [output, update], axis=axis
+            ),
+            outputs,
+            remainder,
+            out_axes_,
+        )
 
-    def compute_shard(outputs, slice_start, slice_size):
-      slice_out = apply_fun_to_slice(slice_start, slice_size)
-      update_slice = partial(dynamic_update_slice_in_dim, i=slice_start)
-      return jax.tree.map(update_slice, outputs, slice_out, out_axes_)
+    if padded_size != in_size:
+      outputs = jax.tree.map(
+          lambda output, axis: jax.lax.slice_in_dim(
+              output, 0, in_size, axis=axis
+          ),
+          outputs,
+          out_axes_,
+      )
 
-    def scan_iteration(outputs, i):
-      new_outputs = compute_shard(outputs, i, shard_size)
-      return new_outputs, ()
+    return outputs
 
-    slice_starts = jnp.arange(0, in_size - shard_size + 1, shard_size)
+  return mapped_fn
 
-    def allocate_buffer(dtype, shape):
-      return jnp.zeros(shape, dtype=dtype)
 
-    outputs = jax.tree.map(allocate_buffer, out_dtypes, out_shapes)
+def _auto_shard_size(
+    module: Callable[..., PytreeJaxArray],
+    batched_args: Sequence[PytreeJaxArray],
+    input_subbatch_dim: int,
+    memory_budget_bytes: int | None,
+    num_partitions: int = 1,
+) -> int:
+  """Largest power of two subbatch size whose inputs and outputs fit a budget.
 
-    if slice_starts.shape[0] > 0:
-      outputs, _ = hk.scan(scan_iteration, outputs, slice_starts)
+  Args:
+    module: Function applied to each subbatch, taking only `batched_args`.
+    batched_args: Arguments that are split into subbatches.
+    input_subbatch_dim: Axis of `batched_args` to split along.
+    memory_budget_bytes: Memory budget for the inputs and outputs of a single
+      subbatch. Defaults to a quarter of the free memory of the default device.
+    num_partitions: Number of devices the batch is split across before
+      subbatching.
 
-    if last_shard_size != shard_size:
-      remainder_start = in_size - last_shard_size
-      outputs = compute_shard(outputs, remainder_start, last_shard_size)
+  Returns:
+    The subbatch size, at least 1 and at most the per-device size of the batch.
 
-    return outputs
+  Raises:
+    ValueError: If no budget is given and the device doesn't report its memory.
+  """
+  if memory_budget_bytes is None:
+    memory_stats = jax.local_devices()[0].memory_stats()
+    if not memory_stats or "bytes_limit" not in memory_stats:
+      raise ValueError(
+          "memory_budget_bytes must be given on devices that don't report"
+          " memory stats."
+      )
+    free_bytes = memory_stats["bytes_limit"] - memory_stats["bytes_in_use"]
+    memory_budget_bytes = free_bytes // 4
+
+  def single_sample(x):
+    axis = input_subbatch_dim % x.ndim
+    shape = x.shape[:axis] + (1,) + x.shape[axis + 1 :]
+    return jax.ShapeDtypeStruct(shape, x.dtype)
+
+  sample_args = jax.tree.map(single_sample, batched_args)
+  sample_out = hk.eval_shape(module, *sample_args)
+  sample_bytes = sum(
+      x.size * x.dtype.itemsize
+      for x in jax.tree.leaves((sample_args, sample_out))
+  )
 
-  return mapped_fn
+  batch_size = jax.tree.leaves(batched_args)[0].shape[input_subbatch_dim]
+  batch_size = max(1, batch_size // num_partitions)
+  max_shard_size = max(1, memory_budget_bytes // max(1, sample_bytes))
+  shard_size = 1 << (max_shard_size.bit_length() - 1)
+  return min(shard_size, batch_size)
 
 
 def inference_subbatch(
     module: Callable[..., PytreeJaxArray],
-    subbatch_size: int,
+    subbatch_size: int | Literal["auto"],
     batched_args: Sequence[PytreeJaxArray],
     nonbatched_args: Sequence[PytreeJaxArray],
     input_subbatch_dim: int = 0,
     output_subbatch_dim: int | None = None,
+    unroll: int | bool = 1,
+    pad_to_multiple: bool = False,
+    in_place_outputs: bool = False,
+    memory_budget_bytes: int | None = None,
+    accum_dtype: jnp.dtype | None = None,
+    mesh: jax.sharding.Mesh | None = None,
+    axis_name: str | None = None,
 ) -> PytreeJaxArray:
-  """Run through subbatches (like batch apply but with split and concat)."""
+  """Run through subbatches (like batch apply but with split and concat).
+
+  Args:
+    module: Function to apply to each subbatch.
+    subbatch_size: Size of each subbatch, or "auto" to pick the largest power
+      of two whose inputs and outputs fit in `memory_budget_bytes`.
+    batched_args: Arguments to split into subbatches along
+      `input_subbatch_dim`.
+    nonbatched_args: Arguments passed unchanged to every subbatch.
+    input_subbatch_dim: Axis of `batched_args` to split along.
+    output_subbatch_dim: Axis of the output to concatenate along, defaults to
+      `input_subbatch_dim`.
+    unroll: See `sharded_apply`.
+    pad_to_multiple: See `sharded_apply`.
+    in_place_outputs: See `sharded_apply`.
+    memory_budget_bytes: Memory budget for the inputs and outputs of a single
+      subbatch when `subbatch_size` is "auto". This doesn't account for the
+      intermediates of `module`, so it should leave headroom for them. Defaults
+      to a quarter of the free memory of the default device.
+    accum_dtype: See `sharded_apply`.
+    mesh: If set, the subbatch dimension is first split across the devices of
+      `mesh` along `axis_name` with `shard_map`, and each device then runs
+      through its part in subbatches. The subbatch dimension must be divisible
+      by the size of the mesh axis, and the output stays sharded along it.
+    axis_name: Name of the mesh axis to split the subbatch dimension along.
+      Required if `mesh` is set.
+
+  Returns:
+    The output of `module` with the subbatches concatenated.
+
+  Raises:
+    ValueError: If `mesh` is set without `axis_name`, or with a negative
+      `output_subbatch_dim`.
+  """
   assert len(batched_args) > 0  # pylint: disable=g-explicit-length-test
 
+  nonbatched_args = tuple(nonbatched_args)
+
   if hk.running_init():
-    args = list(batched_args) + list(nonbatched_args)
-    return module(*args)
+    return module(*batched_args, *nonbatched_args)
 
   if output_subbatch_dim is None:
     output_subbatch_dim = input_subbatch_dim
 
-  def run_module(*batched_args):
-    args = list(batched_args) + list(nonbatched_args)
-    res = module(*args)
-    return res
+  if mesh is not None:
+    if axis_name is None:
+      raise ValueError("axis_name must be given together with mesh.")
+    if output_subbatch_dim < 0:
+      raise ValueError(
+          "output_subbatch_dim must be non-negative when using a mesh, got"
+          f" {output_subbatch_dim}."
+      )
+
+  # The non-batched args are closed over rather than passed through
+  # sharded_apply, so they stay loop invariants of the shard loop.
+  def run_module(*args):
+    return module(*args, *nonbatched_args)
+
+  if subbatch_size == "auto":
+    subbatch_size = _auto_shard_size(
+        run_module,
+        batched_args,
+        input_subbatch_dim,
+        memory_budget_bytes,
+        num_partitions=1 if mesh is None else mesh.shape[axis_name],
+    )
 
   sharded_module = sharded_apply(
       run_module,
       shard_size=subbatch_size,
       in_axes=input_subbatch_dim,
       out_axes=output_subbatch_dim,
+      unroll=unroll,
+      pad_to_multiple=pad_to_multiple,
+      in_place_outputs=in_place_outputs,
+      accum_dtype=accum_dtype,
   )
+
+  if mesh is not None:
+
+    def subbatch_spec(array):
+      axis = input_subbatch_dim % array.ndim
+      return jax.sharding.PartitionSpec(*[None] * axis, axis_name)
+
+    # shard_map requires inputs that already match in_specs on meshes with
+    # Explicit axes, while Auto axes only need a sharding constraint.
+    axis_type = dict(zip(mesh.axis_names, mesh.axis_types))[axis_name]
+
+    def shard_subbatch_dim(array):
+      sharding = jax.sharding.NamedSharding(mesh, subbatch_spec(array))
+      if axis_type == jax.sharding.AxisType.Explicit:
+        return jax.reshard(array, sharding)
+      return jax.lax.with_sharding_constraint(array, sharding)
+
+    batched_args = jax.tree.map(shard_subbatch_dim, batched_args)
+
+    sharded_module = jax.shard_map(
+        sharded_module,
+        mesh=mesh,
+        in_specs=tuple(jax.tree.map(subbatch_spec, batched_args)),
+        out_specs=jax.sharding.PartitionSpec(
+            *[None] * output_subbatch_dim, axis_name
+        ),
+        check_vma=False,
+    )
+
   output = sharded_module(*batched_args)
 
   return output
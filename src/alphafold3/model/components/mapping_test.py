@@ -0,0 +1,311 @@
+# Copyright 2024 DeepMind Technologies Limited
+#
+# AlphaFold 3 source code is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# To request access to the AlphaFold 3 model parameters, follow the process set
+# out at https://github.com/google-deepmind/alphafold3. You may only use these
+# if received directly from Google. Use is subject to terms of use available at
+# https://github.com/google-deepmind/alphafold3/blob/main/WEIGHTS_TERMS_OF_USE.md
+
+"""Tests for the specialized mapping functions."""
+
+import os
+import subprocess
+import sys
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from alphafold3.model.components import mapping
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+
+_SIZE = 13
+_NUM_DEVICES = 4
+
+
+def _fun(linear, x, scale):
+  return {
+      'act': linear(x) * scale,
+      'count': jnp.sum(x > 0, axis=-1, keepdims=True),
+  }
+
+
+def _inputs(axis, size=_SIZE):
+  x = jax.random.normal(jax.random.PRNGKey(0), (size, 5, 3))
+  return jnp.moveaxis(x, 0, axis), jnp.float32(2.0)
+
+
+def _reference(x, scale):
+  return _fun(hk.Linear(4, name='linear'), x, scale)
+
+
+def _check_inference_subbatch(x, scale, subbatch_size, subbatch_dim, **kwargs):
+  """Checks `inference_subbatch` of `_fun` against the full batch."""
+
+  def forward(x, scale):
+    linear = hk.Linear(4, name='linear')
+    return mapping.inference_subbatch(
+        lambda x, scale: _fun(linear, x, scale),
+        subbatch_size,
+        batched_args=[x],
+        nonbatched_args=[scale],
+        input_subbatch_dim=subbatch_dim,
+        **kwargs,
+    )
+
+  reference = hk.transform(_reference)
+  params = reference.init(jax.random.PRNGKey(1), x, scale)
+  jax.tree.map(
+      lambda a, e: np.testing.assert_allclose(a, e, rtol=1e-6, atol=1e-6),
+      jax.jit(hk.transform(forward).apply)(params, None, x, scale),
+      reference.apply(params, None, x, scale),
+  )
+
+
+def _check_mesh_subbatch(explicit_axes, subbatch_dim):
+  """Checks `inference_subbatch` split across a mesh of `_NUM_DEVICES`."""
+  axis_type = (
+      jax.sharding.AxisType.Explicit
+      if explicit_axes
+      else jax.sharding.AxisType.Auto
+  )
+  mesh = jax.make_mesh(
+      (_NUM_DEVICES,),
+      ('d',),
+      axis_types=(axis_type,),
+      devices=jax.devices()[:_NUM_DEVICES],
+  )
+  # Each device gets 4 rows, which leaves a remainder subbatch of 1.
+  x, scale = _inputs(subbatch_dim, size=4 * _NUM_DEVICES)
+  _check_inference_subbatch(x, scale, 3, subbatch_dim, mesh=mesh, axis_name='d')
+
+
+class ShardedApplyTest(parameterized.TestCase):
+
+  def _run(self, axis, shard_size, **kwargs):
+    """Runs `_fun` through `sharded_apply` and on the full batch."""
+
+    def forward(x, scale):
+      linear = hk.Linear(4, name='linear')
+      return mapping.sharded_apply(
+          lambda x, scale: _fun(linear, x, scale),
+          shard_size,
+          in_axes=(axis, None),
+          out_axes=axis,
+          **kwargs,
+      )(x, scale)
+
+    x, scale = _inputs(axis)
+    reference = hk.transform(_reference)
+    params = reference.init(jax.random.PRNGKey(1), x, scale)
+    expected = reference.apply(params, None, x, scale)
+    actual = jax.jit(hk.transform(forward).apply)(params, None, x, scale)
+    return actual, expected
+
+  def _assert_tree_allclose(self, actual, expected, **kwargs):
+    jax.tree.map(
+        lambda a, e: np.testing.assert_allclose(a, e, **kwargs),
+        actual,
+        expected,
+    )
+
+  @parameterized.product(
+      shard_size=[1, 3, 4, 13, 20],
+      axis=[0, 1, -2],
+      option=[
+          {},
+          {'unroll': 2},
+          {'unroll': True},
+          {'pad_to_multiple': True},
+          {'remat': True},
+          {'in_place_outputs': True},
+          {'in_place_outputs': True, 'unroll': 2},
+          {'in_place_outputs': True, 'unroll': True},
+          {'in_place_outputs': True, 'pad_to_multiple': True},
+      ],
+  )
+  def test_matches_full_batch(self, shard_size, axis, option):
+    actual, expected = self._run(axis, shard_size, **option)
+    self._assert_tree_allclose(actual, expected, rtol=1e-6, atol=1e-6)
+
+  @parameterized.parameters(False, True)
+  def test_accum_dtype(self, in_place_outputs):
+    actual, expected = self._run(
+        0, 4, accum_dtype=jnp.bfloat16, in_place_outputs=in_place_outputs
+    )
+    self.assertEqual(actual['act'].dtype, jnp.bfloat16)
+    self.assertEqual(actual['count'].dtype, expected['count'].dtype)
+    np.testing.assert_array_equal(actual['count'], expected['count'])
+    np.testing.assert_allclose(
+        actual['act'].astype(jnp.float32), expected['act'], rtol=1e-2, atol=1e-2
+    )
+
+  def test_remat_gradients(self):
+    x, scale = _inputs(0)
+
+    def loss(shard_kwargs):
+      def forward(x, scale):
+        linear = hk.Linear(4, name='linear')
+        out = mapping.sharded_apply(
+            lambda x: _fun(linear, x, scale), 4, **shard_kwargs
+        )(x)
+        return jnp.sum(out['act'] ** 2)
+
+      return hk.transform(forward)
+
+    params = loss({}).init(jax.random.PRNGKey(1), x, scale)
+    grads = [
+        jax.jit(jax.grad(loss(kwargs).apply))(params, None, x, scale)
+        for kwargs in ({}, {'remat': True})
+    ]
+    self._assert_tree_allclose(*grads, rtol=1e-6)
+
+  @parameterized.named_parameters(
+      dict(testcase_name='scan', option={}),
+      dict(testcase_name='unrolled', option={'unroll': True}),
+      dict(testcase_name='in_place', option={'in_place_outputs': True}),
+      dict(
+          testcase_name='in_place_unrolled',
+          option={'in_place_outputs': True, 'unroll': True},
+      ),
+      dict(
+          testcase_name='in_place_unroll_all_shards',
+          option={'in_place_outputs': True, 'unroll': 4},
+      ),
+  )
+  def test_inline_modules_fail_loudly(self, option):
+    x, _ = _inputs(0)
+    forward = hk.transform(
+        lambda x: mapping.sharded_apply(lambda x: hk.Linear(4)(x), 4, **option)(
+            x
+        )
+    )
+    with self.assertRaisesRegex(AssertionError, 'New parameters were created'):
+      forward.init(jax.random.PRNGKey(1), x)
+
+  def test_none_out_axes_raises(self):
+    x, _ = _inputs(0)
+    forward = hk.transform(
+        lambda x: mapping.sharded_apply(lambda x: x, 4, out_axes=None)(x)
+    )
+    with self.assertRaisesRegex(ValueError, "out_axes can't be None"):
+      forward.apply({}, None, x)
+
+
+class ShardedMapTest(parameterized.TestCase):
+
+  @parameterized.parameters(1, 4)
+  def test_matches_vmap(self, shard_size):
+    x, scale = _inputs(1)
+
+    def fun(x, scale):
+      return _fun(hk.Linear(4, name='linear'), x, scale)
+
+    vmapped = hk.transform(
+        lambda x, scale: hk.vmap(
+            fun, in_axes=(1, None), out_axes=1, split_rng=False
+        )(x, scale)
+    )
+    sharded = hk.transform(
+        lambda x, scale: mapping.sharded_map(
+            fun, shard_size, in_axes=(1, None), out_axes=1
+        )(x, scale)
+    )
+    params = vmapped.init(jax.random.PRNGKey(1), x, scale)
+    jax.tree.map(
+        lambda a, e: np.testing.assert_allclose(a, e, rtol=1e-6, atol=1e-6),
+        jax.jit(sharded.apply)(params, jax.random.PRNGKey(2), x, scale),
+        vmapped.apply(params, None, x, scale),
+    )
+
+
+class AutoShardSizeTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      # Each sample takes 5 * 3 float32 inputs and 5 float32 outputs, i.e. 80
+      # bytes, so a budget of 1000 bytes fits 12 samples.
+      dict(testcase_name='power_of_two', budget=1000, expected=8),
+      dict(testcase_name='exact_fit', budget=160, expected=2),
+      dict(testcase_name='single', budget=1, expected=1),
+      dict(testcase_name='capped_at_batch', budget=10**6, expected=_SIZE),
+      dict(
+          testcase_name='capped_at_partition',
+          budget=10**6,
+          num_partitions=4,
+          expected=_SIZE // 4,
+      ),
+  )
+  def test_shard_size(self, budget, expected, num_partitions=1):
+    x, _ = _inputs(1)
+    shard_size = hk.transform(
+        lambda x: mapping._auto_shard_size(  # pylint: disable=protected-access
+            lambda x: jnp.sum(x, axis=-1),
+            [x],
+            input_subbatch_dim=1,
+            memory_budget_bytes=budget,
+            num_partitions=num_partitions,
+        )
+    ).apply({}, None, x)
+    self.assertEqual(shard_size, expected)
+
+
+class InferenceSubbatchTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      dict(testcase_name='fixed', subbatch_size=4, options={}),
+      dict(testcase_name='auto', subbatch_size='auto',
+           options={'memory_budget_bytes': 1000}),
+      dict(testcase_name='auto_single', subbatch_size='auto',
+           options={'memory_budget_bytes': 1}),
+  )
+  def test_matches_full_batch(self, subbatch_size, options):
+    x, scale = _inputs(1)
+    _check_inference_subbatch(x, scale, subbatch_size, 1, **options)
+
+  @parameterized.product(explicit_axes=[False, True], subbatch_dim=[0, 1])
+  def test_mesh_matches_full_batch(self, explicit_axes, subbatch_dim):
+    if jax.device_count() >= _NUM_DEVICES:
+      _check_mesh_subbatch(explicit_axes, subbatch_dim)
+      return
+    # Host devices can only be forced before JAX starts, so run the check in a
+    # fresh process.
+    env = dict(
+        os.environ,
+        JAX_PLATFORMS='cpu',
+        PYTHONPATH=os.pathsep.join(sys.path),
+        XLA_FLAGS=' '.join([
+            os.environ.get('XLA_FLAGS', ''),
+            f'--xla_force_host_platform_device_count={_NUM_DEVICES}',
+        ]),
+    )
+    result = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'from alphafold3.model.components import mapping_test;'
+            f' mapping_test._check_mesh_subbatch({explicit_axes},'
+            f' {subbatch_dim})',
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    self.assertEqual(result.returncode, 0, msg=result.stderr)
+
+
+if __name__ == '__main__':
+  absltest.main()